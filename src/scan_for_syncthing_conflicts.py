@@ -4,21 +4,22 @@ and open Meld.exe with up to three files to compare.
 """
 
 # Python standard library imports
-import os, subprocess, re, threading, queue, time, hashlib
-from collections import deque
+import os, subprocess, re, threading, time, hashlib, functools, mmap
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 # Third-party imports
-from showinfm import show_in_file_manager
-import send2trash
+# (send2trash, showinfm, and sv_ttk are imported where they're first needed, to keep startup quick.)
 import tkinter as tk
 from tkinter import ttk
 use_sv = True
-if use_sv:
-    import sv_ttk
 
 
 # Constants
-CONFLICT_FILE_REGEX = re.compile(r".*sync-conflict-[0-9A-Z-]*")
+CONFLICT_SENTINEL = ".sync-conflict-"
+CONFLICT_FILE_REGEX = re.compile(r"sync-conflict-[0-9A-Z-]+")
+# Directory names not worth descending into; Syncthing conflicts there are noise at best.
+PRUNE_DIRS = frozenset({'.git', 'node_modules', '.venv', '__pycache__', '.stfolder', '.stversions'})
 def looks_like_conflictfile(filename: str) -> bool:
     """
     Check if a filename looks like a Syncthing conflict file.
@@ -29,7 +30,14 @@ def looks_like_conflictfile(filename: str) -> bool:
     Returns:
     bool: True if the filename looks like a Syncthing conflict file, False otherwise.
     """
-    return CONFLICT_FILE_REGEX.match(filename) and not (filename.startswith('.syncthing') and filename.endswith('.tmp'))
+    # A plain substring search is much cheaper than a regex, and rejects nearly every filename.
+    idx = filename.find(CONFLICT_SENTINEL)
+    if idx == -1:
+        return False
+    if filename.startswith('.syncthing') and filename.endswith('.tmp'):
+        return False
+    # Only now validate the suffix, anchored just past the leading dot.
+    return CONFLICT_FILE_REGEX.match(filename, idx + 1) is not None
 
 
 class TicksPerSecondWatcher:
@@ -37,14 +45,17 @@ class TicksPerSecondWatcher:
 
     def __init__(self, smoothing_factor=10):
         self.ticks = 0
-        self.last_time = time.time()
+        self.last_time = time.monotonic()
         self.last_ticks = 0
         self.ticks_per_second = 0
         self.smoothing_history = deque(maxlen=smoothing_factor)
+        # Running total of smoothing_history, so averaging it doesn't need a sum() each call.
+        self.smoothing_sum = 0.0
 
-    def __call__(self):
-        self.ticks += 1
-        new_time = time.time()
+    def __call__(self, n=1, now=None):
+        """Record n ticks, optionally at an already-read time.monotonic() value."""
+        self.ticks += n
+        new_time = time.monotonic() if now is None else now
         time_since_last = new_time - self.last_time
 
         # Avoid division by zero
@@ -53,10 +64,13 @@ class TicksPerSecondWatcher:
 
         ticks_since_last = self.ticks - self.last_ticks
         this_tps = float(ticks_since_last) / time_since_last
+        if len(self.smoothing_history) == self.smoothing_history.maxlen:
+            self.smoothing_sum -= self.smoothing_history[0]
         self.smoothing_history.append(this_tps)
+        self.smoothing_sum += this_tps
 
         # Calculate average ticks per second over the smoothing history
-        self.ticks_per_second = sum(self.smoothing_history) / len(self.smoothing_history)
+        self.ticks_per_second = self.smoothing_sum / len(self.smoothing_history)
 
         self.last_time = new_time
         self.last_ticks = self.ticks
@@ -64,26 +78,63 @@ class TicksPerSecondWatcher:
         return self.ticks_per_second
     
 
-def scan_for_conflictfiles(conflicts_queue, status_queue, search_dir):
-    """Scan for conflict files in the given directory, and add them to the queue."""
+def scan_for_conflictfiles(conflicts_queue, status_queue, search_dir, prune_dirs=PRUNE_DIRS):
+    """Scan for conflict files in the given directory, and add them to the queue.
+
+    Subdirectories named in prune_dirs aren't searched. If that includes .stversions,
+    so is anything else starting with .stversions."""
     report_frequency = 10.0
-    last_report = time.time()
+    # Only look at the clock once per this many files (a power of two, for a cheap mask test).
+    clock_interval = 256
+    last_report = time.monotonic()
     get_tps = TicksPerSecondWatcher()
     n_scanned = 0
-    for j, (root, dirs, files) in enumerate(os.walk(search_dir)):
-        for i, fp in enumerate(files):
+    prune_stversions = '.stversions' in prune_dirs
+
+    # Walk with os.scandir rather than os.walk, so the file-type info cached on
+    # each DirEntry lets us sort dirs from files without an extra stat per entry.
+    dirs_todo = deque([search_dir])
+    while dirs_todo:
+        root = dirs_todo.pop()
+        try:
+            with os.scandir(root) as it:
+                entries = list(it)
+        except OSError:
+            # Like os.walk, silently skip directories we can't list.
+            continue
+
+        subdirs = []
+        files = []
+        for entry in entries:
+            # As in os.walk, a symlink to a directory counts as a directory, but isn't followed.
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if entry.name in prune_dirs or (prune_stversions and entry.name.startswith('.stversions')):
+                    continue
+                if not entry.is_symlink():
+                    subdirs.append(entry.path)
+            else:
+                files.append(entry)
+        # Reversed so that popping from the end visits them in listing order.
+        dirs_todo.extend(reversed(subdirs))
+
+        for i, entry in enumerate(files):
             n_scanned += 1
-            tps = get_tps()
-            current_time = time.time()
-            if current_time - last_report > 1./report_frequency and tps is not None:
-                last_report = current_time
-                report = dict(tps=tps, n_scanned=n_scanned, n_todo=len(files) - i, root=root)
-                status_queue.put(report)
-            if looks_like_conflictfile(fp):
-                conflicts_queue.put(os.path.join(root, fp))
+            if n_scanned & (clock_interval - 1) == 0:
+                current_time = time.monotonic()
+                tps = get_tps(clock_interval, current_time)
+                if current_time - last_report > 1./report_frequency and tps is not None:
+                    last_report = current_time
+                    report = dict(tps=tps, n_scanned=n_scanned, n_todo=len(files) - i, root=root)
+                    status_queue.append(report)
+            if looks_like_conflictfile(entry.name):
+                conflicts_queue.append(entry.path)
     # Send a final status.
     report = dict(tps=0, n_scanned=n_scanned, n_todo=0, root=None)
-    status_queue.put(report)
+    status_queue.append(report)
 
 
 def normalize_path(path: str) -> str:
@@ -96,39 +147,78 @@ def normalize_path(path: str) -> str:
     Returns:
     str: The normalized path.
     """
-    conflict_indicator = ".sync-conflict-"
-    conflict_length = len(conflict_indicator) + len("NNNNNNNN-NNNNNN-XXXXXXX")
+    conflict_length = len(CONFLICT_SENTINEL) + len("NNNNNNNN-NNNNNN-XXXXXXX")
 
-    conflict_index = path.find(conflict_indicator)
+    conflict_index = path.find(CONFLICT_SENTINEL)
     if conflict_index == -1:
         return path
 
     return path[:conflict_index] + path[conflict_index + conflict_length:]
 
 
+def hash_file(path: str) -> str:
+    """
+    Fingerprint a file's contents, for comparing siblings by eye.
+
+    Parameters:
+    path (str): The file to hash.
+
+    Returns:
+    str: A short hex digest, or '' if the file couldn't be read.
+    """
+    try:
+        with open(path, 'rb') as f:
+            # Hash straight from a memory map rather than copying the file into a bytes object.
+            # mmap refuses empty files, so those just get read.
+            if os.fstat(f.fileno()).st_size == 0:
+                return hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return hashlib.blake2b(mm, digest_size=8).hexdigest()
+    except (OSError, ValueError):
+        return ''
+
+
 class Sibship:
 
     def __init__(self, path: str):
-        self.paths = [path]
         self.normalized = normalize_path(path)
-
-    def maybe_add(self, path: str) -> bool:
-        if normalize_path(path) == self.normalized:
+        self.basename = os.path.basename(self.normalized)
+        # The base path always leads, so paths is already the list to compare.
+        self.paths = [self.normalized, path] if self.normalized != path else [path]
+
+        # Per-row sizes and hashes, keyed by treeview iid, so the sibship row's
+        # summary can be recomputed without reading every child back out of Tk.
+        self.child_sizes: dict[str, int] = {}
+        self.child_hashes: dict[str, str] = {}
+
+        # The paths whose files existed when added, kept up to date as paths come and go,
+        # rather than re-statting them all.
+        self._extant = {p for p in self.paths if os.path.exists(p)}
+
+    def maybe_add(self, path: str, norm: str = None) -> bool:
+        if norm is None:
+            norm = normalize_path(path)
+        if norm == self.normalized:
             self.paths.append(path)
+            if os.path.exists(path):
+                self._extant.add(path)
             if hasattr(self, "callback"):
                 self.callback(path)
             return True
         return False
     
+    def remove(self, path: str):
+        """Forget a path whose file has just been trashed."""
+        if path in self.paths:
+            self.paths.remove(path)
+            self._extant.discard(path)
+
     def get_paths_to_compare(self) -> list[str]:
-        out = self.paths
-        if self.normalized not in out:
-            out = [self.normalized] + out
-        return out
+        return self.paths
     
     @property
     def n_extant(self) -> int:
-        return len([p for p in self.get_paths_to_compare() if os.path.exists(p)])
+        return len(self._extant)
 
 
 class ConflictFileListbox(ttk.Frame):
@@ -146,6 +236,16 @@ class ConflictFileListbox(ttk.Frame):
 
         self.create_widgets()
         self.sibships = []
+        self.sibship_by_norm: dict[str, Sibship] = {}
+        self._dirty_sibships: dict[str, Sibship] = {}
+
+        # Mirror the treeview's rows and parentage in Python, so checking them doesn't go through Tcl.
+        self._tv_iids: set[str] = set()
+        self._tv_children: dict[str, list[str]] = defaultdict(list)
+
+        # Hash files off the UI thread; results come back through hash_queue.
+        self.hash_pool = ThreadPoolExecutor(max_workers=4)
+        self.hash_queue = deque()
 
     def create_widgets(self):
 
@@ -253,22 +353,35 @@ class ConflictFileListbox(ttk.Frame):
         self.grid_rowconfigure(0, weight=1)
 
     def delete_selected_file(self):
+        import tkinter.messagebox
+        import send2trash
+
         # Confirm the deletion.
         selected = self.treeview.selection()[0]
-        sibship = self.find_sibship(selected)
+        sibship = self.find_sibship(self._demangle(selected, check_existence=False))
         do_delete = tk.messagebox.askyesno("Trash file", "Are you sure you want to send the selected file to trash:\n" + selected)
         if do_delete:
             selected_demangled = self._demangle(selected)
-            if selected_demangled in sibship.paths:
-                sibship.paths.remove(selected_demangled)
             # os.remove(selected_demangled)
             send2trash.send2trash(selected_demangled)
-            self.treeview.delete(selected)
-
-            if len(sibship.get_paths_to_compare()) <= 1:
-                # Remove all the items in the sibship from the treeview.
-                for p in sibship.get_paths_to_compare():
-                    self.treeview.delete(p)
+            sibship.remove(selected_demangled)
+            self._delete_row(selected, '' if selected == sibship.normalized else sibship.normalized)
+            sibship.child_sizes.pop(selected, None)
+            sibship.child_hashes.pop(selected, None)
+
+            no_conflicts_left = all(p == sibship.normalized for p in sibship.paths)
+            if no_conflicts_left or sibship.normalized not in self._tv_iids:
+                # Either the sibship is resolved, or its toplevel row was the one trashed;
+                # either way, drop it from the treeview and from the lookup.
+                if sibship.normalized in self._tv_iids:
+                    self._delete_row(sibship.normalized, '')
+                self.sibships.remove(sibship)
+                del self.sibship_by_norm[sibship.normalized]
+                sibship.child_sizes.clear()
+                sibship.child_hashes.clear()
+                self._dirty_sibships.pop(sibship.normalized, None)
+            else:
+                self._update_sibship_row(sibship)
 
     def rescan_directory(self):
         self.searcher.restarted = True
@@ -278,10 +391,7 @@ class ConflictFileListbox(ttk.Frame):
         self.master.quit()
 
     def find_sibship(self, path):
-        for sib in self.sibships:
-            if sib.normalized == normalize_path(path):
-                return sib
-        return None
+        return self.sibship_by_norm.get(normalize_path(path))
 
     def compare_selected_sibship(self, event=None):
         selected_item = self.treeview.selection()[0]
@@ -306,7 +416,7 @@ class ConflictFileListbox(ttk.Frame):
         assert len(self.treeview.selection()) == 1
         selected_item_raw = self.treeview.selection()[0]
         t = time.time()
-        n_children = len(self.treeview.get_children(selected_item_raw))
+        n_children = len(self._tv_children.get(selected_item_raw, ()))
         if n_children > 0:
             # expand/contract the node.
             before = self.treeview.item(selected_item_raw, "open")
@@ -318,14 +428,15 @@ class ConflictFileListbox(ttk.Frame):
 
     def open_directory_of_selected_sibship(self, event=None):
         selected_item_raw = self.treeview.selection()[0]
-        n_children = len(self.treeview.get_children(selected_item_raw))
+        n_children = len(self._tv_children.get(selected_item_raw, ()))
         if n_children == 0:
+            from showinfm import show_in_file_manager
             selected_item = self._demangle(selected_item_raw)
             show_in_file_manager(selected_item)
 
     def open_item(self, event=None):
         selected_item = self.treeview.selection()[0]
-        n_children = len(self.treeview.get_children(selected_item))
+        n_children = len(self._tv_children.get(selected_item, ()))
         if n_children == 0:
             selected_item = self._demangle(selected_item)
             # If windows
@@ -362,12 +473,74 @@ class ConflictFileListbox(ttk.Frame):
         else:
             return path
 
+    def _insert_row(self, parent, iid, values):
+        self.treeview.insert(parent=parent, text=iid, values=values, index=tk.END, iid=iid, open=False)
+        self._tv_iids.add(iid)
+        self._tv_children[parent].append(iid)
+
+    def _forget_row(self, iid):
+        self._tv_iids.discard(iid)
+        for child in self._tv_children.pop(iid, ()):
+            self._forget_row(child)
+
+    def _delete_row(self, iid, parent):
+        # Tk takes the row's children with it, so forget those too.
+        self.treeview.delete(iid)
+        self._forget_row(iid)
+        self._tv_children[parent].remove(iid)
+
+    def _add_file_row(self, sib, path, path_bn=None):
+        txt = sib.normalized
+        if path not in self._tv_iids:
+            if path_bn is None:
+                path_bn = os.path.basename(path)
+            path_dm = self._demangle(path)
+            # One stat for both size and modtime.
+            st = os.stat(path_dm)
+            size = st.st_size
+            # The hash is filled in later, once the pool gets to it.
+            hash = ''
+            if size < 10*1024:
+                self.hash_pool.submit(self._hash_in_background, sib, path, path_dm)
+            modtime = st.st_mtime
+
+            # Convert the modtime to a human-readable string YYYY-MM-DD HH:MM:SS
+            modtime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(modtime))
+
+            self._insert_row(txt, path, values=(path_bn, hash, '', size, modtime))
+            sib.child_sizes[path] = size
+            sib.child_hashes[path] = hash
+
+        # Defer the toplevel update until the whole batch is in.
+        self._dirty_sibships[txt] = sib
+
+    def _hash_in_background(self, sib, path, path_dm):
+        self.hash_queue.append((sib, path, hash_file(path_dm)))
+
+    def _update_sibship_row(self, sib):
+        txt = sib.normalized
+        n = sib.n_extant
+
+        sizes = list(sib.child_sizes.values())
+        sizes_unique = len(set(sizes))
+        size_label = f'SAME: {sizes[0]}' if sizes_unique == 1 else ''#f"{sizes_unique} unique sizes"
+
+        hashes = list(sib.child_hashes.values())
+        hash_set = set(hashes)
+        hashes_unique = len(hash_set)
+        hash_unk = hashes_unique == 1 and '' in hash_set
+        hash_label = '' if hash_unk else ('SAME: ' + hashes[0] if hashes_unique == 1 else '')#f"{hashes_unique} unique hashes"
+
+        self.treeview.item(txt, values=(sib.basename, hash_label, n, size_label, ''))
+
     def update(self):
 
-        # Is there a status update?
-        if not self.status_queue.empty():
-            status = self.status_queue.get(block=False)
-            
+        # Is there a status update? The status deque only holds the latest one.
+        try:
+            status = self.status_queue.pop()
+        except IndexError:
+            status = None
+        if status is not None:
             tps = status['tps']
             if tps is not None and tps > 0:
                 self.scans_per_second.set(f"Scans per second: {tps:.0f}")
@@ -388,78 +561,76 @@ class ConflictFileListbox(ttk.Frame):
             else:
                 self.scanning_root.set("")
 
-        # Is there a new conflict file?
-        if not self.conflicts_queue.empty():
-
-            new_path = self.conflicts_queue.get(block=False)
-
-
-            added = False
-            for sib in self.sibships:
-                added = sib.maybe_add(new_path)
-                if added:
-                    break
-            if not added:
-                self.sibships.append(Sibship(new_path))
-                sib = self.sibships[-1]
-                def callback(path, path_bn=None):
-                    txt = sib.normalized
-                    if not self.treeview.exists(path):
-                        if path_bn is None:
-                            path_bn = os.path.basename(path)
-                        path_dm = self._demangle(path)
-                        size = os.path.getsize(path_dm)
-                        if size < 10*1024:
-                            with open(path_dm, 'rb') as f:
-                                hash = hashlib.md5(f.read()).hexdigest()
-                        else:
-                            hash = ''
-                        modtime = os.path.getmtime(path_dm)
-
-                        # Convert the modtime to a human-readable string YYYY-MM-DD HH:MM:SS
-                        modtime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(modtime))
-
-                        self.treeview.insert(parent=txt, text=path, values=(path_bn, hash, '', size, modtime), index=tk.END, iid=path, open=False)
-                    
-                    # Update the toplevel data.
-                    txt_bn = os.path.basename(txt)
-                    n = sib.n_extant
-
-                    sizes = [self.treeview.item(item, 'values')[3] for item in self.treeview.get_children(txt)]
-                    sizes_unique = len(set(sizes))
-                    size_label = 'SAME: ' + sizes[0] if sizes_unique == 1 else ''#f"{sizes_unique} unique sizes"
-
-                    hashes = [self.treeview.item(item, 'values')[1] for item in self.treeview.get_children(txt)]
-                    hashes_unique = len(set(hashes))
-                    hash_unk = len(set(hashes)) == 1 and '' in set(hashes)
-                    hash_label = '' if hash_unk else ('SAME: ' + hashes[0] if hashes_unique == 1 else '')#f"{hashes_unique} unique hashes"
-
-                    self.treeview.item(txt, values=(txt_bn, hash_label, n, size_label, ''))
-                    
+        # Are there new conflict files? Take a capped batch, so the UI stays responsive.
+        max_batch = 200
+        n_added = 0
+        while n_added < max_batch:
+            try:
+                new_path = self.conflicts_queue.popleft()
+            except IndexError:
+                break
+            n_added += 1
+
+            # Normalize once, and look up the sibship directly rather than asking each in turn.
+            norm = normalize_path(new_path)
+            sib = self.sibship_by_norm.get(norm)
+            if sib is not None:
+                sib.maybe_add(new_path, norm)
+            else:
+                sib = Sibship(new_path)
+                self.sibships.append(sib)
+                self.sibship_by_norm[norm] = sib
+                # Bind this sibship now; a closure would see whatever `sib` is by the time it's called.
+                callback = functools.partial(self._add_file_row, sib)
                 txt = sib.normalized
                 sib.callback = callback
-                txt_bn = os.path.basename(txt)
-                self.treeview.insert(parent='', text=txt, values=(txt_bn, '', sib.n_extant, '', ''), index=tk.END, iid=txt, open=False)
+                self._insert_row('', txt, values=(sib.basename, '', sib.n_extant, '', ''))
                 if os.path.exists(txt):
-                    callback(self._mangle(txt), txt_bn)
+                    callback(self._mangle(txt), sib.basename)
                 callback(new_path)
 
-        self.after(100, self.update)
+        # Fill in any hashes that have finished.
+        while True:
+            try:
+                sib, path, hash = self.hash_queue.popleft()
+            except IndexError:
+                break
+            # The row (or its whole sibship) may have been trashed while it was being hashed.
+            if path in self._tv_iids:
+                sib.child_hashes[path] = hash
+                self.treeview.set(path, 'hash', hash)
+                self._dirty_sibships[sib.normalized] = sib
+
+        # Update the toplevel data once per touched sibship, then redraw once.
+        for sib in self._dirty_sibships.values():
+            self._update_sibship_row(sib)
+        if self._dirty_sibships:
+            self._dirty_sibships.clear()
+            self.treeview.update_idletasks()
+
+        if n_added == max_batch:
+            # There's probably more waiting; come straight back for it.
+            self.after(0, self.update)
+        else:
+            self.after(100, self.update)
 
 
 class Scanner:
 
-    def __init__(self, search_dir):
+    def __init__(self, search_dir, prune_dirs=PRUNE_DIRS):
         self.search_dir = search_dir
+        self.prune_dirs = prune_dirs
         self.restarted = False
         self.start()
 
     def start(self):
         while True:
-            # Start searching.
-            conflicts_queue = queue.Queue()
-            status_queue = queue.Queue()
-            t = threading.Thread(target=scan_for_conflictfiles, args=(conflicts_queue, status_queue, self.search_dir))
+            # Start searching. There's one producer and one consumer per queue, so plain deques
+            # (whose append and popleft are thread-safe) do without queue.Queue's locking.
+            # Only the newest status is ever shown, so older ones are allowed to fall off.
+            conflicts_queue = deque()
+            status_queue = deque(maxlen=1)
+            t = threading.Thread(target=scan_for_conflictfiles, args=(conflicts_queue, status_queue, self.search_dir, self.prune_dirs))
             t.start()
 
             # Start the UI.
@@ -471,13 +642,15 @@ class Scanner:
             app.update()
 
             if use_sv:
+                import sv_ttk
                 sv_ttk.set_theme('light')
 
             # Start the main loop.
             root.mainloop()
 
-            # Kill the searching thread.
+            # Kill the searching thread, and drop any hashing nobody will see.
             t.join()
+            app.hash_pool.shutdown(wait=False, cancel_futures=True)
 
             if self.restarted:
                 self.restarted = False  # Allow the exit button to actually work.
@@ -487,6 +660,15 @@ class Scanner:
 
 
 def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--prune', nargs='*', metavar='DIRNAME', default=None,
+        help=f"Directory names to skip while scanning (default: {' '.join(sorted(PRUNE_DIRS))}). "
+             "Give --prune with no names to search everywhere.",
+    )
+    args = parser.parse_args()
+    prune_dirs = PRUNE_DIRS if args.prune is None else frozenset(args.prune)
 
     # Ask the user for the SEARCH_DIR using a directory selection dialog.
     import tkinter.filedialog
@@ -494,7 +676,7 @@ def main():
     SEARCH_DIR = tkinter.filedialog.askdirectory(title="Select the top-level directory to search for conflict files.", initialdir=default_search_dir)
     SEARCH_DIR = os.path.normpath(SEARCH_DIR)
 
-    Scanner(SEARCH_DIR)
+    Scanner(SEARCH_DIR, prune_dirs)
 
 
 if __name__ == "__main__":